@@ -1,140 +1,282 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-import requests
-import re
+from aiohttp import web
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from typing import Optional
+from cachetools import TTLCache
+import asyncio
+import httpx
+import orjson
 import os
 
-app = Flask(__name__)
+routes = web.RouteTableDef()
+
+# Shared HTTP client, created on startup and closed on cleanup
+HTTP_CLIENT = web.AppKey('http_client', httpx.AsyncClient)
+
+# Default headers for every request to TikTok; the per-video Referer is added per request
+TIKTOK_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'application/json, text/plain, */*',
+}
+
+# Transient upstream failures are retried with exponential backoff
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.2
+MAX_RETRY_AFTER = 2.0  # Cap on a server-requested Retry-After wait, in seconds
+PAGE_TIMEOUT = 5  # Overall deadline for one attempt, including reading the response body
+
+# Recent scrape results keyed by (video_id, lowercased username), so retried requests skip TikTok
+COMMENT_CACHE = TTLCache(maxsize=256, ttl=60)
 
 # Configure CORS
-CORS(app, resources={
-    r"/*": {
-        "origins": ["*"],
-        "methods": ["GET", "POST"],
-        "allow_headers": ["Content-Type"]
-    }
-})
-
-def extract_video_id(url):
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """Add CORS headers to every response and answer preflight requests."""
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        try:
+            response = await handler(request)
+        except web.HTTPException as exc:
+            # Error responses (404, 405, ...) need CORS headers too, or browsers hide the status
+            exc.headers.update(CORS_HEADERS)
+            raise
+    response.headers.update(CORS_HEADERS)
+    return response
+
+def json_response(data, status=200):
+    """Build a JSON response serialized with orjson."""
+    return web.Response(body=orjson.dumps(data), status=status, content_type='application/json')
+
+@dataclass(slots=True, frozen=True)
+class Comment:
+    """A comment left by the target user."""
+    text: str
+    likes: int
+    timestamp: Optional[str]
+
+@lru_cache(maxsize=1024)
+def format_timestamp(create_time):
+    """Format a Unix timestamp; cached since comment times often repeat."""
+    return datetime.fromtimestamp(create_time).strftime('%Y-%m-%d %H:%M:%S')
+
+def leading_digits(text):
+    """Return the run of ASCII digits at the start of text."""
+    return text[:len(text) - len(text.lstrip('0123456789'))]
+
+def find_video_id(url):
+    """Find a numeric video ID in a TikTok URL without following redirects."""
+    # Standard links: tiktok.com/@user/video/<id>
+    _, marker, rest = url.partition('/video/')
+    if marker:
+        video_id = leading_digits(rest)
+        if video_id:
+            return video_id
+    
+    # Other formats with a numeric path segment: tiktok.com/.../<id>
+    _, marker, rest = url.partition('tiktok.com/')
+    if marker:
+        path = rest.partition('?')[0].partition('#')[0]
+        for segment in path.split('/')[1:]:
+            video_id = leading_digits(segment)
+            if video_id:
+                return video_id
+    
+    return None
+
+async def extract_video_id(client, url):
     """Extract video ID from TikTok URL."""
     # Handle different URL formats
-    patterns = [
-        r'/video/(\d+)',
-        r'tiktok\.com/.*?/(\d+)',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            return match.group(1)
+    video_id = find_video_id(url)
+    if video_id:
+        return video_id
     
     # Handle short URLs
     if 'vm.tiktok.com' in url or 'vt.tiktok.com' in url:
         try:
-            response = requests.head(url, allow_redirects=True, timeout=5)
-            expanded_url = response.url
-            match = re.search(r'/video/(\d+)', expanded_url)
-            if match:
-                return match.group(1)
-        except:
+            response = await client.head(url, follow_redirects=True, timeout=5)
+            expanded_url = str(response.url)
+            return find_video_id(expanded_url)
+        except Exception:
             pass
     
     return None
 
-def scrape_tiktok_comments(video_url, target_username):
+def retry_after(response):
+    """Return the capped Retry-After delay in seconds, or 0 if the header is absent or invalid."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return 0
+    
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return 0
+    
+    if not delay > 0:
+        return 0
+    
+    return min(delay, MAX_RETRY_AFTER)
+
+async def fetch_comment_page(client, api_url, params, headers):
+    """Fetch one page of comments, returning None if the request fails."""
+    delay = 0
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(delay)
+        delay = RETRY_BACKOFF * 2 ** attempt
+        
+        try:
+            async with asyncio.timeout(PAGE_TIMEOUT):
+                response = await client.get(api_url, params=params, headers=headers)
+            if response.status_code in RETRY_STATUSES:
+                delay = max(delay, retry_after(response))
+                continue
+            
+            if response.status_code != 200:
+                return None
+            
+            data = orjson.loads(response.content)
+            return data if isinstance(data, dict) else None
+        except (httpx.HTTPError, TimeoutError):
+            continue
+        except Exception:
+            return None
+    
+    return None
+
+async def scrape_tiktok_comments(client, video_url, target_username):
     """
     Scrape comments using TikTok's unofficial API endpoints.
     This method is lightweight and works without a browser.
     """
     try:
-        video_id = extract_video_id(video_url)
+        video_id = await extract_video_id(client, video_url)
         if not video_id:
             raise Exception("Could not extract video ID from URL. Make sure URL is valid.")
         
+        target_lc = target_username.lower()
+        cache_key = (video_id, target_lc)
+        cached = COMMENT_CACHE.get(cache_key)
+        if cached is not None:
+            return list(cached)
+        
         # TikTok's comment API endpoint (unofficial)
         api_url = f"https://www.tiktok.com/api/comment/list/"
         
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Referer': video_url,
-            'Accept': 'application/json, text/plain, */*',
-        }
+        headers = {'Referer': video_url}
         
         comments_found = []
-        cursor = 0
+        page_size = 20
         max_iterations = 5  # Limit iterations to avoid timeout
         
-        for i in range(max_iterations):
-            params = {
+        def page_params(cursor):
+            return {
                 'aweme_id': video_id,
-                'count': 20,
+                'count': page_size,
                 'cursor': cursor
             }
-            
+        
+        # The first page tells us whether there are more comments and where the next cursor starts
+        first_page = await fetch_comment_page(client, api_url, page_params(0), headers)
+        pages = [first_page]
+        
+        try:
+            next_cursor = int(first_page.get('cursor', 0)) if first_page else 0
+        except (TypeError, ValueError):
+            next_cursor = 0
+        
+        # A missing or non-advancing cursor would fetch page 1 again, so only page 1 is used then
+        if first_page and first_page.get('has_more', 0) and next_cursor > 0:
+            # Speculatively fetch the remaining pages concurrently from predicted cursors
+            cursors = [next_cursor + i * page_size for i in range(max_iterations - 1)]
+            tasks = [
+                asyncio.create_task(fetch_comment_page(client, api_url, page_params(cursor), headers))
+                for cursor in cursors
+            ]
             try:
-                response = requests.get(api_url, params=params, headers=headers, timeout=10)
-                
-                if response.status_code != 200:
-                    # If API fails, break and return what we have
-                    break
-                
-                data = response.json()
-                
-                # Check if we got comments
-                comments_list = data.get('comments', [])
-                
-                if not comments_list:
-                    break
-                
-                # Search for target username
-                for comment in comments_list:
-                    try:
-                        user = comment.get('user', {})
-                        username = user.get('unique_id', '') or user.get('nickname', '')
-                        
-                        if username.lower() == target_username.lower():
-                            text = comment.get('text', '')
-                            likes = comment.get('digg_count', 0)
-                            create_time = comment.get('create_time', 0)
-                            
-                            # Format timestamp
-                            from datetime import datetime
-                            timestamp = None
-                            if create_time:
-                                try:
-                                    timestamp = datetime.fromtimestamp(int(create_time)).strftime('%Y-%m-%d %H:%M:%S')
-                                except:
-                                    timestamp = str(create_time)
-                            
-                            comments_found.append({
-                                'text': text,
-                                'likes': likes,
-                                'timestamp': timestamp
-                            })
-                    except Exception as e:
-                        continue
-                
-                # Check if there are more comments
-                has_more = data.get('has_more', 0)
-                if not has_more:
-                    break
-                
-                cursor = data.get('cursor', 0)
-                
-            except requests.exceptions.RequestException:
+                # Consume in cursor order and stop at the last useful page, so fetches
+                # (and retries) past the end of the comment list don't delay the response
+                for task in tasks:
+                    data = await task
+                    pages.append(data)
+                    if not data or not data.get('comments') or not data.get('has_more', 0):
+                        break
+            finally:
+                for task in tasks:
+                    task.cancel()
+        
+        fetch_failed = False
+        
+        for data in pages:
+            # Failed fetches and blocked/errored replies (nonzero status_code, no comments key)
+            # stop here without counting as a complete result
+            if data is None or data.get('status_code', 0) or 'comments' not in data:
+                # If API fails, stop and return what we have
+                fetch_failed = True
                 break
-            except Exception:
+            
+            # Check if we got comments
+            comments_list = data['comments']
+            
+            if not comments_list:
                 break
+            
+            # Search for target username
+            for comment in comments_list:
+                try:
+                    user = comment.get('user')
+                    if not user:
+                        continue
+                    username = user.get('unique_id', '') or user.get('nickname', '')
+                    
+                    if username.lower() == target_lc:
+                        text = comment.get('text', '')
+                        likes = comment.get('digg_count', 0)
+                        create_time = comment.get('create_time', 0)
+                        
+                        # Format timestamp
+                        timestamp = None
+                        if create_time:
+                            try:
+                                timestamp = format_timestamp(int(create_time))
+                            except:
+                                timestamp = str(create_time)
+                        
+                        comments_found.append(Comment(text, likes, timestamp))
+                except Exception as e:
+                    continue
+            
+            # Pages past the end of the comment list are discarded
+            has_more = data.get('has_more', 0)
+            if not has_more:
+                break
+        
+        # Only cache complete results so a failed page is retried rather than pinned
+        if not fetch_failed:
+            COMMENT_CACHE[cache_key] = tuple(comments_found)
         
         return comments_found
         
     except Exception as e:
         raise Exception(f"Error scraping comments: {str(e)}")
 
-@app.route('/', methods=['GET'])
-def home():
+@routes.get('/')
+async def home(request):
     """Home endpoint."""
-    return jsonify({
+    return json_response({
         'message': 'TikTok Comment Scraper API',
         'version': '4.0',
         'status': 'Production Ready',
@@ -154,66 +296,66 @@ def home():
         }
     })
 
-@app.route('/scrape', methods=['POST'])
-def scrape():
+@routes.post('/scrape')
+async def scrape(request):
     """API endpoint to scrape TikTok comments."""
     try:
-        data = request.get_json()
+        data = await request.json()
         
         if not data:
-            return jsonify({'error': 'No JSON data provided'}), 400
+            return json_response({'error': 'No JSON data provided'}, status=400)
         
         if 'video_url' not in data:
-            return jsonify({'error': 'Missing video_url in request body'}), 400
+            return json_response({'error': 'Missing video_url in request body'}, status=400)
             
         if 'username' not in data:
-            return jsonify({'error': 'Missing username in request body'}), 400
+            return json_response({'error': 'Missing username in request body'}, status=400)
         
         video_url = data['video_url'].strip()
         username = data['username'].strip().lstrip('@')
         
         if not video_url:
-            return jsonify({'error': 'video_url cannot be empty'}), 400
+            return json_response({'error': 'video_url cannot be empty'}, status=400)
             
         if not username:
-            return jsonify({'error': 'username cannot be empty'}), 400
+            return json_response({'error': 'username cannot be empty'}, status=400)
         
         # Validate TikTok URL
         if 'tiktok.com' not in video_url:
-            return jsonify({'error': 'Invalid TikTok URL. Must contain tiktok.com'}), 400
+            return json_response({'error': 'Invalid TikTok URL. Must contain tiktok.com'}, status=400)
         
         # Scrape comments
-        comments = scrape_tiktok_comments(video_url, username)
+        comments = await scrape_tiktok_comments(request.app[HTTP_CLIENT], video_url, username)
         
-        return jsonify({
+        return json_response({
             'success': True,
             'username': username,
             'video_url': video_url,
             'comments': comments,
             'count': len(comments),
             'message': f'Found {len(comments)} comment(s) from @{username}'
-        }), 200
+        }, status=200)
         
     except Exception as e:
-        return jsonify({
+        return json_response({
             'success': False,
             'error': str(e)
-        }), 500
+        }, status=500)
 
-@app.route('/health', methods=['GET'])
-def health():
+@routes.get('/health')
+async def health(request):
     """Health check endpoint."""
-    return jsonify({
+    return json_response({
         'status': 'healthy',
         'service': 'tiktok-comment-scraper',
         'version': '4.0',
         'method': 'API-based (lightweight)'
-    }), 200
+    }, status=200)
 
-@app.route('/test', methods=['GET'])
-def test():
+@routes.get('/test')
+async def test(request):
     """Test endpoint to verify API is working."""
-    return jsonify({
+    return json_response({
         'status': 'ok',
         'message': 'API is working! Use POST /scrape to scrape comments.',
         'test_request': {
@@ -225,11 +367,26 @@ def test():
                 'username': 'target_user'
             }
         }
-    }), 200
+    }, status=200)
+
+async def on_startup(app):
+    """Create the HTTP client shared by all requests."""
+    # HTTP/2 multiplexes concurrent page fetches over one pooled TLS connection
+    limits = httpx.Limits(max_connections=20, max_keepalive_connections=20)
+    app[HTTP_CLIENT] = httpx.AsyncClient(http2=True, limits=limits, timeout=10, headers=TIKTOK_HEADERS)
+
+async def on_cleanup(app):
+    """Close the shared HTTP client."""
+    await app[HTTP_CLIENT].aclose()
+
+app = web.Application(middlewares=[cors_middleware])
+app.add_routes(routes)
+app.on_startup.append(on_startup)
+app.on_cleanup.append(on_cleanup)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     print(f"🚀 Starting TikTok Comment Scraper on port {port}")
     print(f"📡 Health check: http://localhost:{port}/health")
     print(f"🔍 Scrape endpoint: http://localhost:{port}/scrape")
-    app.run(host='0.0.0.0', port=port, debug=False)
+    web.run_app(app, host='0.0.0.0', port=port)